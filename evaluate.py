@@ -1,25 +1,21 @@
 
 from copy import deepcopy
 from progress.bar import Bar
+from torch.nn.modules.utils import consume_prefix_in_state_dict_if_present
 
 from model import ValueModel
 from game import Game
 from player import *
 
 def load_player(params=None):
-    model = ValueModel()
-
-    if torch.cuda.is_available():
-        device = torch.device('cuda')
-        model.to(device)
-        if torch.cuda.device_count() >= 1:
-            model = torch.nn.DataParallel(model)
-        if params:
-            model.load_state_dict(torch.load(params))
-    else:
-        device = torch.device('cpu')
-        if params:
-            model.load_state_dict(torch.load(params, map_location='cpu'))
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    model = ValueModel().to(device)
+
+    if params:
+        # older checkpoints were saved from a DataParallel wrapper
+        state_dict = torch.load(params, map_location=device)
+        consume_prefix_in_state_dict_if_present(state_dict, 'module.')
+        model.load_state_dict(state_dict)
 
     return ValueModelPlayer(model, device)
 
@@ -31,11 +27,11 @@ def ask(question):
         if answer == 'n' or answer == 'no': return False
         hint = ' (y/n)'
 
-def evaluate(player_i, player_j, games=2, display=False):
+def evaluate(player_i, player_j, games=2, display=False, quiet=False):
     if player_i is player_j: player_j = deepcopy(player_j)
     score = {player_i:0, player_j:0, None:0}
 
-    for n in Bar('Evaluating').iter(range(games)):
+    for n in range(games) if quiet else Bar('Evaluating').iter(range(games)):
         game = Game()
 
         # choose starting player
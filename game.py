@@ -1,7 +1,47 @@
 
-from itertools import product
+import math
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+@njit(cache=True)
+def _valid_actions(pieces, macro, n):
+    moves = []
+    for a in range(n):
+        for b in range(n):
+            if macro[a,b] == 0 and math.copysign(1., macro[a,b]) > 0:
+                for i in range(n*a, n*(a+1)):
+                    for j in range(n*b, n*(b+1)):
+                        if pieces[i,j] == 0:
+                            moves.append((i, j))
+    return moves
+
+@njit(cache=True)
+def _is_win(board, player):
+    n = len(board)
+    diagonal = antidiagonal = True
+    for i in range(n):
+        row = col = True
+        for j in range(n):
+            row = row and board[i,j] == player
+            col = col and board[j,i] == player
+        if row or col: return True
+        diagonal = diagonal and board[i,i] == player
+        antidiagonal = antidiagonal and board[n-1-i,i] == player
+    return diagonal or antidiagonal
+
+@njit(cache=True)
+def _update_macro(macro, v0, v1):
+    free = macro[v0,v1] != 0
+    for a in range(len(macro)):
+        for b in range(len(macro)):
+            if macro[a,b] == 0:
+                macro[a,b] = 0. if free or (a == v0 and b == v1) else -0.
+
 class Game:
     '''
     Macro board data:
@@ -26,7 +66,7 @@ class Game:
 
     def get_state(self, player=1):
         state = self.pieces[np.newaxis,:,:]
-        return player*state.astype(np.float32)
+        return np.multiply(state, player, dtype=np.float32)
 
     def get_symmetries(self, player=1):
         syms, state = [], self.get_state(player)
@@ -35,28 +75,17 @@ class Game:
                 s = np.rot90(state, rot, (-2,-1))
                 if flip: s = np.flip(s, -1)
                 syms.append(s)
-        return syms
+        return np.stack(syms)
 
     def get_microboard(self, index):
         return self[tuple(slice(self.n*i, self.n*(i+1)) for i in index)]
 
     def get_valid_actions(self):
-        moves = []
-        for u in product(range(self.n), range(self.n)):
-            if not self.macro[u] and 0 < np.copysign(1, self.macro[u]):
-                for move in product(*(range(self.n*i, self.n*(i+1)) for i in u)):
-                    if self.pieces[move] == 0:
-                        moves.append(move)
-        return moves
+        return _valid_actions(self.pieces, self.macro, self.n)
 
     def is_win(self, player=1, board=None):
         if board is None: board = self.macro
-        for i in range(len(board)):
-            if (board[i,:] == player).all(): return True
-            if (board[:,i] == player).all(): return True
-        if (board.diagonal() == player).all(): return True
-        if (board[::-1].diagonal() == player).all(): return True
-        return False
+        return _is_win(board, float(player))
 
     def is_full(self, board=None):
         if board is None: board = self.macro
@@ -83,9 +112,7 @@ class Game:
             if self.is_win(player, uboard):
                 self.macro[_u] = player
 
-        for u in product(range(self.n), range(self.n)):
-            if not self.macro[u]:
-                self.macro[u] = 0. if self.macro[_v] or u == _v else -0.
+        _update_macro(self.macro, *_v)
 
         self.move += 1
         return self
@@ -14,3 +14,14 @@ class ValueModel(nn.Module):
         x = self.relu(self.conv_a(x))
         x = self.sig(self.conv_b(x))
         return x.flatten()
+
+# inference batches are padded to one of these sizes so compiled graphs see few shapes
+BUCKETS = 16, 64, 256, 1024, 4096, 16384
+
+def bucket(n):
+    return next((b for b in BUCKETS if b >= n), n)
+
+def autocast(device):
+    # only on GPUs with native bfloat16, where it is actually faster
+    enabled = device.type == 'cuda' and torch.cuda.is_bf16_supported(including_emulation=False)
+    return torch.autocast(device.type, torch.bfloat16, enabled=enabled)
@@ -1,39 +1,85 @@
 
 import re, random, torch
+import numpy as np
 from copy import deepcopy
 
+from model import autocast, bucket
+
 class ValueModelPlayer:
-    def __init__(self, model, device):
+    def __init__(self, model, device, pad=False):
         self.model = model
         self.device = device
+        self.pad = pad
+        self.staging = self.inputs = None
 
     def get_action(self, game, epsilon=0):
         self.model.eval()
         return self.get_action_and_value(game, epsilon)[0]
 
     def get_action_and_value(self, game, epsilon):
-        actions = game.get_valid_actions()
-        random.shuffle(actions)
-        next_states = []
+        return self.get_actions_and_values([game], epsilon)[0]
 
-        # sometimes make a random move
-        if random.random() < epsilon:
-            actions = [random.choice(actions)]
+    @torch.no_grad()
+    def get_actions_and_values(self, games, epsilon):
+        # current states come first, followed by the next states of each game
+        states = [game.get_state() for game in games]
+        results = [None] * len(games)
+        candidates = []
 
-        # get all next states
-        for action in actions:
-            g = deepcopy(game).execute_move(action)
-            end_value = g.is_over()
-            if end_value == 1: return action, end_value
-            next_states.append(g.flip().get_state())
+        for k, game in enumerate(games):
+            actions = game.get_valid_actions()
+            random.shuffle(actions)
+            next_states = []
+
+            # sometimes make a random move
+            if random.random() < epsilon:
+                actions = [random.choice(actions)]
+
+            # get all next states
+            for action in actions:
+                g = deepcopy(game).execute_move(action)
+                end_value = g.is_over()
+                if end_value == 1:
+                    results[k] = action, end_value
+                    break
+                next_states.append(g.flip().get_state())
+            else:
+                candidates.append((k, actions))
+                states += next_states
+
+        # get values for all states of all games in one pass
+        values = self.get_values(states)
+
+        # find max for each game
+        start = len(games)
+        for k, actions in candidates:
+            next_values = [1 - v for v in values[start:start + len(actions)]]
+            i = max(range(len(next_values)), key=next_values.__getitem__)
+            results[k] = actions[i], next_values[i]
+            start += len(actions)
+
+        return [result + (value,) for result, value in zip(results, values)]
+
+    def get_values(self, states):
+        n, shape = len(states), states[0].shape
+        capacity = bucket(n)
+
+        # compiled models see only bucket sizes, others run exactly n rows
+        m = capacity if self.pad else n
 
-        # get values for all next states, find max
-        next_states = torch.tensor(next_states).to(self.device)
-        next_values = 1 - self.model(next_states)
-        max_value, i = next_values.max(0)
-        action = actions[i]
+        # pinned staging buffer and device input buffer, reused between calls
+        if self.staging is None or len(self.staging) < capacity:
+            on_cuda = self.device.type == 'cuda'
+            self.staging = torch.zeros((capacity,) + shape, pin_memory=on_cuda)
+            self.inputs = self.staging
+            if on_cuda: self.inputs = torch.zeros_like(self.staging, device=self.device)
 
-        return action, max_value
+        np.stack(states, out=self.staging[:n].numpy())
+        if self.inputs is not self.staging:
+            self.inputs[:n].copy_(self.staging[:n], non_blocking=True)
+        with autocast(self.device):
+            values = self.model(self.inputs[:m])
+        return values[:n].float().tolist()
 
 class RandomPlayer:
     def get_action(self, game):
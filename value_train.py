@@ -1,75 +1,190 @@
 
 from itertools import count
+from concurrent.futures import ThreadPoolExecutor
 import os, random, time, torch
-from progress.bar import Bar
+import numpy as np
+from contextlib import nullcontext
+from torch import distributed as dist, multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 
 from game import Game
-from model import ValueModel
+from model import ValueModel, BUCKETS, autocast
 from player import ValueModelPlayer, GreedyPlayer
 from evaluate import evaluate
 
-def self_play(player, games=1, alpha=0.2, epsilon=0.2, display=False):
-    data = []
+class Samples:
+    '''Preallocated (state, value) storage that doubles in size when full.'''
 
-    for n in Bar('Self play').iter(range(games)):
-        game = Game()
+    def __init__(self, capacity, shape):
+        capacity = max(capacity, 1)
+        self.states = np.empty((capacity,) + shape, np.float32)
+        self.values = np.empty(capacity, np.float32)
+        self.size = 0
 
-        for m in count():
+    def push(self, states, values):
+        k = len(states)
+        while self.size + k > len(self.values):
+            n = 2 * len(self.values)
+            self.states = np.resize(self.states, (n,) + self.states.shape[1:])
+            self.values = np.resize(self.values, n)
+        self.states[self.size:self.size+k] = states
+        self.values[self.size:self.size+k] = values
+        self.size += k
+
+    def data(self):
+        return self.states[:self.size], self.values[:self.size]
+
+def with_negations(syms, value):
+    k = len(syms)
+    states = np.concatenate([syms, -syms])
+    values = np.repeat(np.array([value, 1-value], np.float32), k)
+    return states, values
+
+def self_play(player, games=1, alpha=0.2, epsilon=0.2, display=False, quiet=False):
+    finished, report = 0, max(1, games // 10)
+    samples = Samples(games * 1024, Game().get_state().shape)
+    if not games: return samples.data()
+    playing = [Game() for _ in range(games)]
+
+    while playing:
+        # actions and current state values of all games in one pass
+        results = player.get_actions_and_values(playing, epsilon)
+        still_playing = []
+
+        for game, (action, v_prime, value) in zip(playing, results):
             if display: game.display()
-            action, v_prime = player.get_action_and_value(game, epsilon)
 
             # update the value of the current state
-            state = torch.tensor([game.get_state()]).to(player.device)
-            value = player.model(state)
             value = value + alpha * (v_prime - value)
-            data += [(s, value) for s in game.get_symmetries()]
-            data += [(-s, 1-value) for s in game.get_symmetries()]
+            samples.push(*with_negations(game.get_symmetries(), value))
 
             game.execute_move(action)
             end_value = game.is_over()
 
             if end_value:
                 if display: game.display()
-                data += [(s, end_value) for s in game.get_symmetries()]
-                data += [(-s, 1-value) for s in game.get_symmetries()]
-                break
+                samples.push(*with_negations(game.get_symmetries(), end_value))
+                finished += 1
+                if not quiet and finished % report == 0:
+                    print('\rSelf play %d/%d' % (finished, games), end='', flush=True)
+                continue
 
             game.flip()
+            still_playing.append(game)
 
-    return data
+        playing = still_playing
 
-def batches(data, n):
-    l = len(data)
-    for i in range(0, l, n):
-        x, y = zip(*data[i:min(i + n, l)])
-        yield torch.tensor(x), torch.tensor(y)
+    if not quiet: print()
+    return samples.data()
 
-def train(model, data, lossfn, optimr, device, epochs=10, batch_size=128):
-    for epoch in range(epochs):
-        random.shuffle(data)
+def materialize(data, device):
+    X, Y = (torch.from_numpy(a) for a in data)
+
+    # pinned memory lets the upload be asynchronous
+    if device.type == 'cuda': X, Y = X.pin_memory(), Y.pin_memory()
+
+    return X.to(device, non_blocking=True), Y.to(device, non_blocking=True)
+
+def batches(X, Y, n, shuffle=True):
+    if not shuffle:
+        yield from zip(X.split(n), Y.split(n))
+        return
+
+    # drop the partial last batch so training only sees one batch shape
+    perm = torch.randperm(len(X), device=X.device)
+    for i in range(0, max(len(X) - n, 0) + 1, n):
+        yield X[perm[i:i+n]], Y[perm[i:i+n]]
 
-        # train
+def pad(x, n):
+    if len(x) >= n: return x
+    return torch.cat([x, x.new_zeros((n - len(x),) + x.shape[1:])])
+
+class Prefetcher:
+    '''Prepares the next minibatch on a side stream while the current one is used.'''
+
+    def __init__(self, batches, device):
+        self.batches, self.device = iter(batches), device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        if self.stream: self.stream.wait_stream(torch.cuda.current_stream(device))
+        self.preload()
+
+    def preload(self):
+        with torch.cuda.stream(self.stream):
+            batch = next(self.batches, None)
+            if batch is not None:
+                batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            self.batch = batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.batch is None: raise StopIteration
+        batch = self.batch
+        if self.stream:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_stream(self.stream)
+            for t in batch: t.record_stream(stream)
+        self.preload()
+        return batch
+
+def train(model, data, lossfn, eval_lossfn, optimr, device, epochs=10, batch_size=128, eval_every=5):
+    X, Y = materialize(data, device)
+
+    # the distributed wrapper sits underneath torch.compile
+    ddp = getattr(model, '_orig_mod', model)
+    if not isinstance(ddp, DistributedDataParallel): ddp = None
+
+    for epoch in range(epochs):
+        # train, letting ranks with fewer minibatches drop out early
+        losses, steps = torch.zeros((), device=device), 0
         model.train()
-        for x, y in batches(data, batch_size):
-            optimr.zero_grad()
-            x, y = x.to(device), y.to(device)
-            loss = lossfn(model(x), y)
-            loss.backward()
-            optimr.step()
-            del x, y, loss
-
-        # evaluate
-        losses = []
-        model.eval()
-        with torch.no_grad():
-            for x, y in batches(data, batch_size):
-                x, y = x.to(device), y.to(device)
-                loss = lossfn(model(x), y)
-                losses.append(loss.item())
-                del x, y, loss
+        with ddp.join() if ddp else nullcontext():
+            for x, y in Prefetcher(batches(X, Y, batch_size), device):
+                optimr.zero_grad(set_to_none=True)
+                with autocast(device):
+                    out = model(x)
+                loss = lossfn(out.float(), y)
+                loss.backward()
+                optimr.step()
+                losses += loss.detach()
+                steps += 1
+
+        report = ['Epoch %d |' % epoch, 'Loss: %.4e' % (losses/steps).item()]
+
+        # evaluate every few epochs, summing the loss on the device
+        if (epoch + 1) % eval_every == 0:
+            losses = torch.zeros((), device=device)
+            model.eval()
+            with torch.no_grad():
+                for x, y in Prefetcher(batches(X, Y, batch_size, False), device):
+                    with autocast(device):
+                        out = model(pad(x, batch_size))[:len(x)]
+                    losses += eval_lossfn(out.float(), y)
+            report += ['|', 'Eval loss: %.4e' % (losses/Y.numel()).item()]
+
+        print(*report)
+
+def snapshot(net):
+    return {k: v.to('cpu', copy=True) for k, v in net.state_dict().items()}
 
-        print('Epoch %d |' % epoch,
-              'Loss: %.4e' % (sum(losses)/len(losses)))
+def cpu_player(weights, seed):
+    random.seed(seed)
+    torch.set_num_threads(1)
+    model = ValueModel()
+    model.load_state_dict(weights)
+    return ValueModelPlayer(model, torch.device('cpu'))
+
+def self_play_worker(weights, seed, games, alpha, epsilon):
+    return self_play(cpu_player(weights, seed), games, alpha, epsilon, quiet=True)
+
+def evaluate_worker(weights, seed, games):
+    return evaluate(cpu_player(weights, seed), GreedyPlayer(), games, quiet=True)
+
+def fan_out(pool, workers, worker, weights, games, *args):
+    shares = [games // workers + (i < games % workers) for i in range(workers)]
+    tasks = [(weights, random.randrange(2**32), n) + args for n in shares if n]
+    return pool.starmap(worker, tasks)
 
 def hms(t):
     h, m, s = int(t/60/60), int(t/60)%60, t%60
@@ -77,64 +192,122 @@ def hms(t):
     if m: return '%dm%02.ds' % (m, s)
     return '%.1fs' % s
 
-def main(learn_rate, alpha, epsilon, seed=None):
+def main(learn_rate, alpha, epsilon, workers=0, seed=None):
+    # when launched with torchrun on several GPUs, train with one process per GPU
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if distributed:
+        dist.init_process_group('nccl')
+        device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    rank = dist.get_rank() if distributed else 0
+
+    # each process plays different games
     if seed:
         torch.manual_seed(seed)
-        random.seed(seed)
+        random.seed(seed + rank)
 
     # build model, loss function, optimizer, scheduler
     print('\nBuilding model...')
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-    model = ValueModel().to(device)
-    if torch.cuda.device_count() >= 1: model = torch.nn.DataParallel(model)
+    net = ValueModel().to(device)
+    model = DistributedDataParallel(net, device_ids=[device.index]) if distributed else net
+    model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+
+    # inference does not need the distributed wrapper
+    inference = model
+    if distributed: inference = torch.compile(net, mode='reduce-overhead', fullgraph=False)
     lossfn = torch.nn.MSELoss()
-    optimr = torch.optim.Adam(model.parameters(), lr=learn_rate)
+    eval_lossfn = torch.nn.MSELoss(reduction='sum')
+    optimr = torch.optim.Adam(model.parameters(), lr=learn_rate, fused=device.type == 'cuda')
     print(model, 'on', device, 'using', optimr)
 
+    # trigger compilation for the training batch and every inference bucket
+    print('\nCompiling model...')
+    batch_size, shape = 128, Game().get_state().shape
+    with autocast(device):
+        model.train()
+        model(torch.zeros((batch_size,) + shape, device=device)).sum().backward()
+        optimr.zero_grad(set_to_none=True)
+        model.eval()
+        inference.eval()
+        with torch.no_grad():
+            model(torch.zeros((batch_size,) + shape, device=device))
+            for n in BUCKETS:
+                inference(torch.zeros((n,) + shape, device=device))
+
     # make players
-    model_player = ValueModelPlayer(model, device)
+    model_player = ValueModelPlayer(inference, device, pad=True)
     opponent = GreedyPlayer()
 
+    # worker processes that play games with a CPU copy of the model
+    pool = mp.get_context('spawn').Pool(workers) if workers else None
+
     # keep track of the best model
     best_score = 0, 0, 0
     save_dir = 'results'
 
+    # write checkpoints in the background
+    saver, saving = ThreadPoolExecutor(max_workers=1), []
+
+    # games per iteration for self play and for evaluation
+    games = 100
+
     # data queue
-    data, data_limit = [], None
+    data, data_limit = None, None
 
     for iteration in count():
         print('\n ==== ITERATION', iteration + 1, '====')
 
-        # save model parameters
-        if not os.path.isdir(save_dir): os.mkdir(save_dir)
-        torch.save(model.state_dict(),
-            os.path.join(save_dir, 'model_' + str(iteration) + '.params'))
-        if iteration and score > best_score:
-            torch.save(model.state_dict(), os.path.join(save_dir, 'best.params'))
-            best_score = score
+        # save a snapshot of the model parameters
+        weights = snapshot(net)
+        if rank == 0:
+            # raise any error from the previous iteration's writes
+            for future in saving: future.result()
+            if not os.path.isdir(save_dir): os.mkdir(save_dir)
+            saving = [saver.submit(torch.save, weights,
+                os.path.join(save_dir, 'model_' + str(iteration) + '.params'))]
+            if iteration and score > best_score:
+                saving.append(saver.submit(torch.save, weights,
+                    os.path.join(save_dir, 'best.params')))
+                best_score = score
 
         # get data from self play
         print()
         start = time.time()
         _epsilon = 0.8*epsilon*2**(-iteration/32) + 0.2*epsilon
         print('Epsilon =', _epsilon)
-        new_data = self_play(model_player, 100, alpha, _epsilon)
-        data = (data + new_data)[-data_limit:] if data_limit else new_data
+        if pool:
+            results = fan_out(pool, workers, self_play_worker, weights, games, alpha, _epsilon)
+            new_data = tuple(map(np.concatenate, zip(*results)))
+            print('Self play %d/%d' % (games, games))
+        else:
+            new_data = self_play(model_player, games, alpha, _epsilon)
+        if data_limit and data:
+            data = tuple(np.concatenate(d)[-data_limit:] for d in zip(data, new_data))
+        else:
+            data = new_data
         print('Time taken:', hms(time.time() - start))
-        print('New data points:', len(new_data))
+        print('New data points:', len(new_data[0]))
 
         # train the model
         print('\nTraining...')
         start = time.time()
-        train(model, data, lossfn, optimr, device, 10)
+        train(model, data, lossfn, eval_lossfn, optimr, device, 10, batch_size)
         print('Time taken:', hms(time.time() - start))
 
-        # evaluate against opponent
-        print()
-        start = time.time()
-        score = evaluate(model_player, opponent, 100)
-        print('Time taken:', hms(time.time() - start))
-        print('%d wins, %d draws, %d losses' % score)
+        # evaluate against opponent, only the main process uses the score
+        if rank == 0:
+            print()
+            start = time.time()
+            if pool:
+                results = fan_out(pool, workers, evaluate_worker, snapshot(net), games)
+                score = tuple(map(sum, zip(*results)))
+                print('Evaluating %d/%d' % (games, games))
+            else:
+                score = evaluate(model_player, opponent, games)
+            print('Time taken:', hms(time.time() - start))
+            print('%d wins, %d draws, %d losses' % score)
 
 if __name__ == '__main__':
     import argparse
@@ -142,5 +315,6 @@ if __name__ == '__main__':
     parser.add_argument('--learn_rate', '-lr', type=float, default=1e-4)
     parser.add_argument('--alpha', '-a', type=float, default=0.2)
     parser.add_argument('--epsilon', '-e', type=float, default=0.5)
+    parser.add_argument('--workers', '-w', type=int, default=0)
     parser.add_argument('--seed', type=int, default=None)
     main(**vars(parser.parse_args()))